@@ -0,0 +1,109 @@
+#!/usr/local/bin/python3
+#coding: utf-8
+
+"""
+Benchmark of `FileHandler.split_line` against the regex previously used to parse the pairing lines,
+on large synthetic round documents with and without the club and federation columns.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+
+from typing import Callable, List, Optional, Tuple
+
+#############
+# Constants #
+#############
+
+OLD_PLAYER_REGEX = re.compile(r"^(\d+) +(\w+) +\d+.+ +(\w+) +\d+")
+REPEAT = 5
+
+CLUBS = ["Chess Club Paris 1", "Schachklub Berlin 1920 e.V.", "Club d'Echecs de Marseille", "Manchester Chess Club", "Kasparov Academy"]
+FEDERATIONS = ["FRA", "GER", "ENG", "USA", "IND", "NOR"]
+RESULTS = ["1 - 0", "0 - 1", "½ - ½", "-"]
+# Lines of the document which aren't boards
+NOISE = [
+    "Round 3 on 2021/08/14 at 14:00",
+    "Bo. No. Name Rtg Club/City FED Pts. Result Pts. Name Rtg Club/City FED",
+    "The games of the 3rd round will be played with a 3+2 time control, " * 4,
+]
+
+Columns = Tuple[int, str, str]
+
+#############
+# Functions #
+#############
+
+def username() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits + "_", k=random.randint(4, 20)))
+
+def board(table_number: int, long: bool, played: bool) -> Tuple[str, Columns]:
+    """Return a pairing line and the columns it should be parsed into. Before the round is `played`, there is no result column"""
+    left, right = username(), username()
+    def player(name: str) -> str:
+        columns = [name, str(random.randint(1200, 2800))]
+        if long:
+            columns += [random.choice(CLUBS), random.choice(FEDERATIONS), str(random.randint(0, 8))]
+        return " ".join(columns)
+    result = f" {random.choice(RESULTS)}" if played else ""
+    return f"{table_number} {player(left)}{result} {player(right)}", (table_number, left, right)
+
+def document(nb_boards: int, long: bool, played: bool) -> Tuple[List[str], List[Optional[Columns]]]:
+    lines: List[str] = []
+    expected: List[Optional[Columns]] = []
+    for table_number in range(1, nb_boards + 1):
+        if table_number % 50 == 1:
+            lines.extend(NOISE)
+            expected.extend([None] * len(NOISE))
+        line, columns = board(table_number, long, played)
+        lines.append(line)
+        expected.append(columns)
+    return lines, expected
+
+def old_split_line(line: str) -> Optional[Columns]:
+    match = OLD_PLAYER_REGEX.match(line)
+    if match is None:
+        return None
+    (table_number, player_1, player_2) = match.groups()
+    return (int(table_number), player_1, player_2)
+
+def bench(name: str, split_line: Callable[[str], Optional[Columns]], lines: List[str], expected: List[Optional[Columns]]) -> None:
+    """Report the best of `REPEAT` runs, the others being slowed down by the rest of the machine"""
+    elapsed = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        parsed = [split_line(line) for line in lines]
+        elapsed = min(elapsed, time.perf_counter() - start)
+    wrong = sum(columns != truth for columns, truth in zip(parsed, expected))
+    print(f"    {name}: {elapsed * 1000:.1f}ms ({len(lines) / elapsed:.0f} lines/s), {wrong} lines parsed wrongly")
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--boards", default=100000, type=int)
+    args = parser.parse_args()
+    # The logs of `pairing` are created in the current directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, here)
+    import pairing
+    random.seed(0)
+    for long, played in ((False, True), (True, True), (False, False), (True, False)):
+        lines, expected = document(args.boards, long, played)
+        print(f"{args.boards} boards, {'with' if long else 'without'} club and federation columns, {'with' if played else 'without'} results:")
+        bench("regex", old_split_line, lines, expected)
+        bench("tokenizer", pairing.FileHandler.split_line, lines, expected)
+
+########
+# Main #
+########
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/local/bin/python3
+#coding: utf-8
+
+"""
+Benchmark of `Pairing.create_game` over the `http1` (requests) and `http2` (httpx) transports,
+against a local HTTP/2 server mimicking the lichess challenge API.
+Needs `hypercorn` (`pip3 install hypercorn`), and must be run without `-O` so that `pairing.BASE` points to localhost.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from typing import Any, Callable, Set
+
+#############
+# Constants #
+#############
+
+PORT = 9663
+# Time taken by the fake server to create a game, in seconds
+SERVER_LATENCY = 0.05
+
+###########
+# Classes #
+###########
+
+class FakeLichess:
+    """ASGI app answering challenges with a random game id, and recording every connection used"""
+
+    def __init__(self: FakeLichess) -> None:
+        self.connections: Set[Any] = set()
+
+    async def __call__(self: FakeLichess, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            return
+        self.connections.add(tuple(scope["client"]))
+        while (await receive()).get("more_body"):
+            pass
+        body = b""
+        if scope["method"] == "POST":
+            await asyncio.sleep(SERVER_LATENCY)
+            body = json.dumps({"game": {"id": "".join(random.choices(string.ascii_letters, k=8))}}).encode()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+#############
+# Functions #
+#############
+
+def start_server(app: FakeLichess) -> None:
+    config = Config()
+    config.bind = [f"localhost:{PORT}"]
+    config.loglevel = "WARNING"
+    async def run() -> None:
+        # Never shut down, the thread dies with the benchmark. Also avoids installing signal handlers outside of the main thread
+        await serve(app, config, shutdown_trigger=asyncio.Event().wait)
+    threading.Thread(target=asyncio.run, args=(run(),), daemon=True).start()
+    time.sleep(1)
+
+def bench(pairing: Any, app: FakeLichess, transport: str, nb_games: int, concurrency: int) -> None:
+    p = pairing.Pairing(
+        pairing.Db(),
+        concurrency=concurrency,
+        scheduler=pairing.RequestScheduler(rate=1e6, burst=nb_games),
+        transport=transport,
+        )
+    pair = pairing.Pair("white", "black")
+    app.connections.clear()
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: p.create_game(pair), range(nb_games)))
+    elapsed = time.monotonic() - start
+    print(f"{transport}: {nb_games} games in {elapsed:.2f}s ({nb_games / elapsed:.0f}/s), {len(app.connections)} connections")
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--games", default=512, type=int)
+    parser.add_argument("--concurrency", default=64, type=int)
+    args = parser.parse_args()
+    # The db and the logs of `pairing` are created in the current directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, here)
+    import pairing
+    pairing.log.setLevel("WARNING")
+    app = FakeLichess()
+    start_server(app)
+    for transport in ("http1", "http2"):
+        bench(pairing, app, transport, args.games, args.concurrency)
+
+########
+# Main #
+########
+
+if __name__ == "__main__":
+    main()
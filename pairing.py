@@ -7,24 +7,40 @@ Script making the pairings for FIDE binance tournament
 
 from __future__ import annotations
 
+import aiohttp
 import argparse
+import asyncio
 import csv
+import hashlib
+import httpx
 import json
 import logging
 import logging.handlers
 import requests
 import os
+import queue
+import random
 import time
-import re
 import sqlite3
+import string
 import sys
+import threading
 
 from argparse import RawTextHelpFormatter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from dataclasses import dataclass
+from datetime import datetime
 from dotenv import load_dotenv
+from multidict import CIMultiDict, CIMultiDictProxy
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError: # not available outside of linux, `fetch --watch` polls the file instead
+    INotify = None
 
 #############
 # Constants #
@@ -32,26 +48,109 @@ from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 load_dotenv()
 
-PLAYER_REGEX = re.compile(r"^(\d+) +(\w+) +\d+.+ +(\w+) +\d+") # re.compile(r"(\w+) +\d+")
+# A pairing line is `table_number player rating [...] result [...] player rating [...]`, the columns in brackets
+# (points, club, federation...) can contain anything but a result. Before the round is played, the result is usually `-` or missing,
+# both players then have the same columns after their rating
+USERNAME_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+USERNAME_LENGTHS = range(2, 31)
+RATING_LENGTHS = range(3, 5) # unrated players have a rating of 0
+RESULT_TOKENS = frozenset(["-", "–", "1-0", "0-1", "½-½", "1/2-1/2", "+-", "-+", "--", "0-0", "=-="])
 
 G_DOC_PATH = "round_{}.txt"
+# To bump whenever `Db.upgrade_db` changes, older databases are upgraded when opened
+SCHEMA_VERSION = 1
+# Lichess' bulk pairing needs each player's `challenge:bulk` token, stored as `{"username": "token", ...}`
+PLAYER_TOKENS_PATH = "player_tokens.json"
 LOG_PATH = "pair.log"
 
+# How often `fetch --watch` checks the document when it can't be notified of its changes, in seconds
+FETCH_POLL_INTERVAL = 0.5
+
 BASE = "https://lichess.org"
 if __debug__: 
     BASE = "http://localhost:9663"  
 PAIRING_API = BASE + "/api/challenge/admin/{}/{}"
 LOOKUP_API = BASE + "/games/export/_ids"
+BULK_PAIRING_API = BASE + "/api/bulk-pairing"
+WATCH_API = BASE + "/api/stream/games/{}"
+GAMES_BY_USER_API = BASE + "/api/games/user/{}"
+USERS_API = BASE + "/api/users"
+
+# Several admin tokens can be given as `TOKENS=token1,token2`, challenges are then spread between them, each having its own rate limit
+TOKENS = [token for token in os.getenv("TOKENS", os.getenv("TOKEN", "")).split(",") if token]
+API_KEY = {"Authorization": f"Bearer {TOKENS[0] if TOKENS else None}", "Accept": "application/x-ndjson"}
+
+# Retries are handled by `Retrier`, with decorrelated jitter: each delay is drawn between `RETRY_BASE` and 3 times the previous one
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BASE = 0.5 # seconds
+RETRY_CAP = 20 # seconds
+RETRY_DEADLINE = 60 # seconds, no retry is attempted past that time since the first try
+# The circuit breaker of a host opens after that many failures in a row, and lets a request through again after the cooldown
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30 # seconds
+
+# Lichess game statuses, with the `rounds.result` to store when there is no winner. `None` means the game is still running
+GAME_STATUSES: Dict[str, Optional[int]] = {
+    "created": None,
+    "started": None,
+    "aborted": 3,
+    "mate": 3,
+    "resign": 3,
+    "stalemate": 2,
+    "timeout": 2, # opponent left and the draw was claimed
+    "draw": 2,
+    "outoftime": 2, # flagged against insufficient material
+    "cheat": 3,
+    "noStart": 3,
+    "unknownFinish": 3,
+    "insufficientMaterialClaim": 2,
+    "variantEnd": 2,
+}
+STATUS_NAMES = {10: "created", 20: "started", 25: "aborted", 30: "mate", 31: "resign", 32: "stalemate", 33: "timeout",
+    34: "draw", 35: "outoftime", 36: "cheat", 37: "noStart", 38: "unknownFinish", 39: "insufficientMaterialClaim", 60: "variantEnd"}
 
-API_KEY = {"Authorization": f"Bearer {os.getenv('TOKEN')}", "Accept": "application/x-ndjson"}
+CLOCK = {
+    "clock.limit": 600,
+    "clock.increment": 2,
+}
+CHALLENGE_PAYLOAD = {
+    "rated": "true",
+    **CLOCK,
+    "color": "white"
+}
 
-RETRY_STRAT = Retry(
-    total=5,
-    backoff_factor=5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    method_whitelist=["GET"]
-)
-ADAPTER = HTTPAdapter(max_retries=RETRY_STRAT)
+# Number of challenges created in parallel by `pair`, can be overridden with `--concurrency`
+PAIRING_CONCURRENCY = 8
+# Token bucket for the challenge API, in requests per second and maximum burst, can be overridden with `--rate` and `--burst`
+CHALLENGE_RATE = 4.0
+CHALLENGE_BURST = 16
+# When a challenge failed, games between the two players created up to that many seconds before it are considered its own
+RECONCILE_MARGIN = 30
+# Lichess asks to wait a full minute after a 429 when no `Retry-After` is given
+RATE_LIMIT_DELAY = 60
+# Results are saved as soon as that many games have been received from the export stream
+RESULT_BATCH_SIZE = 32
+# Maximum number of game ids accepted by `LOOKUP_API` in a single request
+LOOKUP_CHUNK_SIZE = 300
+# Games followed by a single connection of `watch`, the endpoint accepts up to 500
+WATCH_CHUNK_SIZE = 300
+# Maximum number of usernames per request to `USERS_API`
+USERS_CHUNK_SIZE = 300
+# How long the validation of a player is trusted, in seconds
+PLAYER_CACHE_TTL = 24 * 3600
+# A document modified less than that many seconds before being imported may change again without its mtime changing,
+# coarser filesystem timestamps included, so the next `fetch` hashes it instead of trusting its size and mtime
+RACY_MTIME_MARGIN = 2
+WATCH_RECONNECT_DELAY = 5 # seconds
+# Lichess sends a keep-alive line every few seconds, a stream silent for longer is considered dead and reopened
+WATCH_READ_TIMEOUT = 30 # seconds
+# HTTP timeouts in seconds, can be overridden with `--connect-timeout` and `--read-timeout`
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+# Idle seconds before a pre-warmed connection of the asyncio engine is closed
+KEEPALIVE_TIMEOUT = 60.0
+# Seconds before `pair --at` at which the connections are opened, late enough for the server not to close them as idle
+PREWARM_LEAD = 5.0
 
 
 ########
@@ -79,23 +178,152 @@ log.addHandler(handler_2)
 # Classes #
 ###########
 
+UNPAIRED_PLAYERS_QUERY = '''SELECT 
+    rowId, 
+    white_player,
+    black_player
+    FROM rounds
+    WHERE lichess_game_id IS NULL AND NOT removed AND round_nb = ?
+    '''
+
+UNFINISHED_GAMES_QUERY = '''SELECT 
+    rowId, 
+    lichess_game_id
+    FROM rounds
+    WHERE lichess_game_id IS NOT NULL AND result IS NULL AND round_nb = ?
+    '''
+
+GAME_IDS_QUERY = '''SELECT 
+    lichess_game_id
+    FROM rounds
+    WHERE lichess_game_id IS NOT NULL AND round_nb = ?
+    '''
+
+UNCONFIRMED_CHALLENGES_QUERY = '''SELECT 
+    rounds.rowId, 
+    white_player,
+    black_player,
+    sent_at
+    FROM rounds
+    JOIN challenges ON challenges.row_id = rounds.rowId
+    WHERE lichess_game_id IS NULL AND confirmed_at IS NULL AND round_nb = ?
+    '''
+
+# Players are identified by their lichess id, the lowercased username
+UNCHECKED_PLAYERS_QUERY = '''SELECT 
+    username
+    FROM (
+        SELECT lower(white_player) AS username FROM rounds WHERE NOT removed AND round_nb = ?
+        UNION
+        SELECT lower(black_player) FROM rounds WHERE NOT removed AND round_nb = ?
+    )
+    WHERE username NOT IN (SELECT username FROM players WHERE checked_at > ?)
+    '''
+
+INVALID_BOARDS_QUERY = '''SELECT 
+    rounds.rowId, 
+    white_player,
+    black_player,
+    white.reason,
+    black.reason
+    FROM rounds
+    LEFT JOIN players AS white ON white.username = lower(white_player) AND white.checked_at > ?
+    LEFT JOIN players AS black ON black.username = lower(black_player) AND black.checked_at > ?
+    WHERE (NOT white.valid OR NOT black.valid) AND NOT removed AND round_nb = ?
+    '''
+
+ROUND_BOARDS_QUERY = '''SELECT 
+    rowId, 
+    white_player,
+    black_player,
+    lichess_game_id IS NOT NULL,
+    removed
+    FROM rounds
+    WHERE round_nb = ?
+    '''
+
 class Db:
 
     def __init__(self: Db) -> None:
         self.con = sqlite3.connect('FIDE_binance.db', isolation_level=None)
         self.cur = self.con.cursor()
+        # Per-connection settings, WAL makes NORMAL safe against corruption, only the last commits can be lost on power failure
+        self.cur.execute("PRAGMA synchronous = NORMAL")
+        self.cur.execute("PRAGMA cache_size = -16000") # 16Mb
+        version = self.cur.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION and self.cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rounds'").fetchone():
+            log.info(f"Upgrading the database from version {version} to {SCHEMA_VERSION}")
+            self.upgrade_db()
 
     def create_db(self: Db) -> None:
         # Since the event is divided in two parts, `round_nb` will first indicate the round_nb number in the round-robin then advancement in the knockdown event
-        # `result` 0 = black wins, 1 = white wins, 2 = draw, 3 = unknown (everything else)
+        # `result` 0 = black wins, 1 = white wins, 2 = draw, 3 = unknown (everything else, like aborted games, see `GAME_STATUSES`)
         # `rowId` is the primary key and is create silently
+        # `removed` 1 = the board is no longer in the round's document, and won't be paired
         self.cur.execute('''CREATE TABLE rounds
                (
                white_player description VARCHAR(30) NOT NULL, 
                black_player description VARCHAR(30) NOT NULL, 
                lichess_game_id CHAR(8), 
                result INT,
-               round_nb INT)''')
+               round_nb INT,
+               removed INT NOT NULL DEFAULT 0)''')
+        self.upgrade_db()
+
+    def upgrade_db(self: Db) -> None:
+        """Idempotent, bring an existing database to the current schema and performance settings"""
+        # WAL is persistent and lets `broadcast` read while `pair` is writing
+        self.cur.execute("PRAGMA journal_mode = WAL")
+        if "removed" not in (column[1] for column in self.cur.execute("PRAGMA table_info(rounds)")):
+            self.cur.execute("ALTER TABLE rounds ADD COLUMN removed INT NOT NULL DEFAULT 0")
+        # Boards imported twice by older versions of `fetch`, the copy that was paired (or the first one) is kept
+        self.cur.execute('''DELETE FROM rounds
+            WHERE lichess_game_id IS NULL AND EXISTS (
+                SELECT 1 FROM rounds AS other
+                WHERE other.round_nb = rounds.round_nb AND other.white_player = rounds.white_player AND other.black_player = rounds.black_player
+                AND (other.lichess_game_id IS NOT NULL OR other.rowId < rounds.rowId))''')
+        if self.cur.rowcount > 0:
+            log.warning(f"{self.cur.rowcount} duplicated boards deleted")
+        try:
+            self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS rounds_round_players ON rounds (round_nb, white_player, black_player)")
+        except sqlite3.IntegrityError:
+            log.error("Some boards were paired several times, only one game of each must be kept before upgrading")
+            raise
+        self.cur.execute("CREATE INDEX IF NOT EXISTS rounds_round_game ON rounds (round_nb, lichess_game_id)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS rounds_round_result ON rounds (round_nb, result)")
+        # Journal of the challenges, a row is `sent` before its challenge is, and `confirmed` along with its game id.
+        # Rows sent but not confirmed are the ones a crashed `pair` may or may not have created
+        self.cur.execute('''CREATE TABLE IF NOT EXISTS challenges
+               (
+               row_id INTEGER PRIMARY KEY,
+               sent_at REAL NOT NULL,
+               confirmed_at REAL)''')
+        # Cache of the players' lichess accounts, `reason` explains why an account can't be paired
+        self.cur.execute('''CREATE TABLE IF NOT EXISTS players
+               (
+               username TEXT PRIMARY KEY,
+               valid INT NOT NULL,
+               reason TEXT,
+               checked_at REAL NOT NULL)''')
+        # Last version of each round's document imported by `fetch`
+        self.cur.execute('''CREATE TABLE IF NOT EXISTS round_files
+               (
+               round_nb INTEGER PRIMARY KEY,
+               size INT NOT NULL,
+               mtime_ns INT NOT NULL,
+               sha256 CHAR(64) NOT NULL)''')
+        self.cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def check_query_plans(self: Db) -> bool:
+        """Return `True` if all the lookups by round use an index instead of a full scan"""
+        ok = True
+        for query in (UNPAIRED_PLAYERS_QUERY, UNFINISHED_GAMES_QUERY, GAME_IDS_QUERY, UNCONFIRMED_CHALLENGES_QUERY, ROUND_BOARDS_QUERY):
+            plan = [row[-1] for row in self.cur.execute("EXPLAIN QUERY PLAN " + query, (0,))]
+            log.info(f"{' '.join(query.split())}: {plan}")
+            if not any("USING INDEX" in step or "USING COVERING INDEX" in step for step in plan):
+                log.error(f"Query is not using any index: {plan}")
+                ok = False
+        return ok
 
     def show(self: Db) -> None:
         tables = self.cur.execute("""SELECT name 
@@ -110,6 +338,20 @@ class Db:
             rows = self.cur.execute(f'SELECT * from {table}')
             log.info(f"{table} rows: {[t for t in rows]}")
 
+    @contextmanager
+    def transaction(self: Db) -> Iterator[None]:
+        """Group all the writes of the block in a single transaction, committed at the end of it.
+        The connection is in autocommit mode otherwise. Nested calls join the outermost transaction"""
+        if self.con.in_transaction:
+            yield
+            return
+        self.cur.execute("BEGIN")
+        try:
+            yield
+        except:
+            self.cur.execute("ROLLBACK")
+            raise
+        self.cur.execute("COMMIT")
 
     def add_players(self: Db, pair: Pair, round_nb: int) -> None:
         self.cur.execute('''INSERT INTO rounds
@@ -120,14 +362,48 @@ class Db:
             ) VALUES (?, ?, ?)
             ''', (pair.white_player, pair.black_player, round_nb))
 
+    def add_players_many(self: Db, pairs: Iterable[Pair], round_nb: int) -> int:
+        """Same as `add_players` for several pairs, in a single transaction. `pairs` is consumed lazily, return the number of rows inserted"""
+        with self.transaction():
+            self.cur.executemany('''INSERT INTO rounds
+                (
+                white_player,
+                black_player,
+                round_nb
+                ) VALUES (?, ?, ?)
+                ''', ((pair.white_player, pair.black_player, round_nb) for pair in pairs))
+            nb_rows = self.cur.rowcount
+        return nb_rows
+
+    def get_round_boards(self: Db, round_nb: int) -> Dict[Pair, Tuple[int, bool, bool]]:
+        """Return the `(row_id, paired, removed)` of every board stored for the round"""
+        return {Pair(white_player, black_player): (int(row_id), bool(paired), bool(removed))
+            for row_id, white_player, black_player, paired, removed in self.cur.execute(ROUND_BOARDS_QUERY, (round_nb,))}
+
+    def set_removed(self: Db, row_ids: List[int], removed: bool) -> None:
+        """Flag the boards `row_ids` as removed from their round's document, or back in it, in a single transaction"""
+        with self.transaction():
+            self.cur.executemany('''UPDATE rounds
+                SET removed = ?
+                WHERE
+                rowId = ?''', [(removed, row_id) for row_id in row_ids])
+
+    def get_round_file(self: Db, round_nb: int) -> Optional[Tuple[int, int, str]]:
+        """Return the `(size, mtime_ns, sha256)` of the round's document when it was last imported"""
+        return self.cur.execute("SELECT size, mtime_ns, sha256 FROM round_files WHERE round_nb = ?", (round_nb,)).fetchone()
+
+    def set_round_file(self: Db, round_nb: int, size: int, mtime_ns: int, sha256: str) -> None:
+        self.cur.execute('''INSERT OR REPLACE INTO round_files
+            (
+            round_nb,
+            size,
+            mtime_ns,
+            sha256
+            ) VALUES (?, ?, ?, ?)
+            ''', (round_nb, size, mtime_ns, sha256))
+
     def get_unpaired_players(self: Db, round_nb: int) -> List[Tuple[int, Pair]]:
-        raw_data = list(self.cur.execute('''SELECT 
-            rowId, 
-            white_player,
-            black_player
-            FROM rounds
-            WHERE lichess_game_id IS NULL AND round_nb = ?
-            ''', (round_nb,)))
+        raw_data = list(self.cur.execute(UNPAIRED_PLAYERS_QUERY, (round_nb,)))
         log.info(f"Round {round_nb}, {len(raw_data)} games to be created")
         return [(int(row_id), Pair(white_player, black_player))for row_id, white_player, black_player in raw_data]
 
@@ -137,22 +413,80 @@ class Db:
             WHERE
             rowId = ?''', (game_id, row_id))
 
+    def add_lichess_game_ids(self: Db, ids: List[Tuple[int, str]]) -> None:
+        """Same as `add_lichess_game_id` for a list of `(row_id, game_id)`, in a single transaction which also confirms their challenges"""
+        now = time.time()
+        with self.transaction():
+            self.cur.executemany('''UPDATE rounds
+                SET lichess_game_id = ?
+                WHERE
+                rowId = ?''', [(game_id, row_id) for row_id, game_id in ids])
+            self.cur.executemany('''UPDATE challenges
+                SET confirmed_at = ?
+                WHERE
+                row_id = ?''', [(now, row_id) for row_id, _ in ids])
+
+    def mark_sent(self: Db, row_ids: List[int]) -> None:
+        """Journal that the challenges of `row_ids` are about to be sent, in a single transaction"""
+        now = time.time()
+        with self.transaction():
+            self.cur.executemany('''INSERT OR REPLACE INTO challenges
+                (
+                row_id,
+                sent_at
+                ) VALUES (?, ?)
+                ''', [(row_id, now) for row_id in row_ids])
+
+    def clear_sent(self: Db, row_ids: List[int]) -> None:
+        """Remove from the journal the boards whose challenge was finally not sent, in a single transaction"""
+        with self.transaction():
+            self.cur.executemany("DELETE FROM challenges WHERE row_id = ?", [(row_id,) for row_id in row_ids])
+
+    def get_unchecked_players(self: Db, round_nb: int) -> List[str]:
+        """Return the ids of the players of the round not validated within `PLAYER_CACHE_TTL`"""
+        raw_data = list(self.cur.execute(UNCHECKED_PLAYERS_QUERY, (round_nb, round_nb, time.time() - PLAYER_CACHE_TTL)))
+        log.info(f"Round {round_nb}, {len(raw_data)} players to be checked")
+        return [username for username, in raw_data]
+
+    def add_player_checks(self: Db, checks: List[Tuple[str, Optional[str]]]) -> None:
+        """Cache a list of `(username, reason)`, `reason` being `None` for valid players, in a single transaction"""
+        now = time.time()
+        with self.transaction():
+            self.cur.executemany('''INSERT OR REPLACE INTO players
+                (
+                username,
+                valid,
+                reason,
+                checked_at
+                ) VALUES (?, ?, ?, ?)
+                ''', [(username, reason is None, reason, now) for username, reason in checks])
+
+    def get_invalid_boards(self: Db, round_nb: int) -> Dict[int, str]:
+        """Return the boards with a player known to be invalid, and why"""
+        since = time.time() - PLAYER_CACHE_TTL
+        raw_data = list(self.cur.execute(INVALID_BOARDS_QUERY, (since, since, round_nb)))
+        return {int(row_id): ", ".join(f"{player} {reason}" for player, reason in ((white_player, white_reason), (black_player, black_reason)) if reason)
+            for row_id, white_player, black_player, white_reason, black_reason in raw_data}
+
+    def get_boards_to_pair(self: Db, round_nb: int, skip: Set[int]) -> List[Tuple[int, Pair]]:
+        """Return the unpaired boards of the round, except `skip` and the ones with an invalid player"""
+        invalid = self.get_invalid_boards(round_nb)
+        for row_id, reason in invalid.items():
+            log.warning(f"Board {row_id} skipped: {reason}")
+        return [(row_id, pair) for row_id, pair in self.get_unpaired_players(round_nb) if row_id not in skip and row_id not in invalid]
+
+    def get_unconfirmed_challenges(self: Db, round_nb: int) -> List[Tuple[int, Pair, float]]:
+        """Return the boards whose challenge was sent by a previous run but never confirmed, with the time it was sent"""
+        raw_data = list(self.cur.execute(UNCONFIRMED_CHALLENGES_QUERY, (round_nb,)))
+        return [(int(row_id), Pair(white_player, black_player), sent_at) for row_id, white_player, black_player, sent_at in raw_data]
+
     def get_unfinished_games(self: Db, round_nb: int) -> Dict[str, int]:
-        raw_data = list(self.cur.execute('''SELECT 
-            rowId, 
-            lichess_game_id
-            FROM rounds
-            WHERE lichess_game_id IS NOT NULL AND result IS NULL AND round_nb = ?
-            ''', (round_nb,)))
+        raw_data = list(self.cur.execute(UNFINISHED_GAMES_QUERY, (round_nb,)))
         log.info(f"Round {round_nb}, {len(raw_data)} games unfinished")
         return {game_id: int(row_id) for row_id, game_id in raw_data}
 
     def get_game_ids(self: Db, round_nb: int) -> str:
-        raw_data = list(self.cur.execute('''SELECT 
-            lichess_game_id
-            FROM rounds
-            WHERE lichess_game_id IS NOT NULL AND round_nb = ?
-            ''', (round_nb,)))
+        raw_data = list(self.cur.execute(GAME_IDS_QUERY, (round_nb,)))
         log.info(f"Round {round_nb}, {len(raw_data)} games started")
         log.debug(raw_data)
         return " ".join((x[0] for x in raw_data))
@@ -163,119 +497,1222 @@ class Db:
             WHERE
             rowId = ?''', (result, row_id))
 
+    def add_game_results(self: Db, results: List[Tuple[int, int]]) -> None:
+        """Same as `add_game_result` for a list of `(row_id, result)`, in a single transaction"""
+        with self.transaction():
+            self.cur.executemany('''UPDATE rounds
+                SET result = ?
+                WHERE
+                rowId = ?''', [(result, row_id) for row_id, result in results])
+
 class FileHandler:
 
     def __init__(self: FileHandler, db: Db) -> None:
         self.db = db
 
     def get_pairing(self: FileHandler, round_nb: int) -> List[Pair]:
-        l: List[Pair] = []
+        return list(self.iter_pairing(round_nb))
+
+    def iter_pairing(self: FileHandler, round_nb: int) -> Iterator[Pair]:
+        """Yield the pairs of the round as the document is read"""
         with open(G_DOC_PATH.format(round_nb)) as input_:
-            for line in input_:
-                match = PLAYER_REGEX.match(line)
-                if match is None:
-                    continue
-                log.debug(match.groups())
-                (table_number, player_1, player_2) = match.groups()
-                if int(table_number) % 2: # odd numbers have white player on left 
-                    pair = Pair(white_player=player_1, black_player=player_2)
+            yield from self.parse_pairing(input_)
+
+    def parse_pairing(self: FileHandler, lines: Iterable[str]) -> Iterator[Pair]:
+        """Nothing is logged per line, it would cost more than the parsing itself"""
+        for line in lines:
+            columns = self.split_line(line)
+            if columns is None:
+                continue
+            (table_number, player_1, player_2) = columns
+            if table_number % 2: # odd numbers have white player on left 
+                yield Pair(white_player=player_1, black_player=player_2)
+            else:
+                yield Pair(white_player=player_2, black_player=player_1)
+
+    @staticmethod
+    def split_line(line: str) -> Optional[Tuple[int, str, str]]:
+        """Return the `(table_number, left_player, right_player)` of a pairing line, `None` if it isn't one.
+        The left player is the second column, the right player the first username followed by a rating after the result.
+        Without a result, it's the one splitting the line in two halves ending with the same kinds of columns"""
+        tokens = line.split()
+        if len(tokens) < 5 or not tokens[0].isdecimal() or not is_rating(tokens[2]) or not is_username(tokens[1]):
+            return None
+        end = len(tokens) - 1
+        for i in range(3, end):
+            if tokens[i] in RESULT_TOKENS:
+                for j in range(i + 1, end):
+                    if is_rating(tokens[j + 1]) and is_username(tokens[j]):
+                        return (int(tokens[0]), tokens[1], tokens[j])
+                return None
+        candidates = [i for i in range(3, end) if is_rating(tokens[i + 1]) and is_username(tokens[i])]
+        if len(candidates) > 1:
+            # eg `1 alice 2000 Berlin 1920 GER 3 bob 1900 Berlin 1920 GER 2`, only `bob` leaves `Berlin 1920 GER 3` and `Berlin 1920 GER 2`
+            kinds = [column_kind(token) for token in tokens]
+            def same_columns(i: int) -> int:
+                left, right = i - 1, end
+                while left > 2 and right > i + 1 and kinds[left] == kinds[right]:
+                    left -= 1
+                    right -= 1
+                return i - 1 - left
+            candidates.sort(key=same_columns, reverse=True) # stable, the first one wins ties
+        return (int(tokens[0]), tokens[1], tokens[candidates[0]]) if candidates else None
+
+    def watch(self: FileHandler, round_nb: int, on_import: Optional[Callable[[], None]] = None) -> None:
+        """Import the boards appended to the round's document as they are written, until interrupted. Only complete lines are parsed,
+        and each of them only once. `on_import` is called after each batch of new boards is saved.
+        Boards already stored are left as they are, run `fetch` without `--watch` to take the other edits into account"""
+        path = G_DOC_PATH.format(round_nb)
+        stored = set(self.db.get_round_boards(round_nb))
+        inode = None
+        offset = 0
+        partial_line = b""
+        notifier = None
+        if INotify is not None:
+            notifier = INotify()
+            # The directory is watched rather than the file, so that we're notified too when it's replaced by an editor
+            notifier.add_watch(os.path.dirname(os.path.abspath(path)), inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE | inotify_flags.CREATE | inotify_flags.MOVED_TO)
+        log.info(f"Round {round_nb}, watching {path} ({'inotify' if notifier else 'polling'})")
+        try:
+            while True:
+                try:
+                    with open(path, "rb") as input_:
+                        stat = os.fstat(input_.fileno())
+                        if stat.st_ino != inode or stat.st_size < offset:
+                            # Replaced or truncated, read from the start again, known boards are skipped anyway
+                            inode = stat.st_ino
+                            offset = 0
+                            partial_line = b""
+                        input_.seek(offset)
+                        appended = input_.read()
+                except FileNotFoundError:
+                    appended = b""
+                offset += len(appended)
+                lines, _, partial_line = (partial_line + appended).rpartition(b"\n")
+                new = [pair for pair in dict.fromkeys(self.parse_pairing(lines.decode().splitlines())) if pair not in stored]
+                if new:
+                    self.db.add_players_many(new, round_nb)
+                    stored.update(new)
+                    log.info(f"Round {round_nb}, {len(new)} new boards imported")
+                    if on_import is not None:
+                        on_import()
+                if notifier is not None:
+                    # Any change in the directory wakes us up, the timeout is only a safety net
+                    notifier.read(timeout=int(FETCH_POLL_INTERVAL * 1000))
                 else:
-                    pair = Pair(white_player=player_2, black_player=player_1)
-                log.debug(pair)
-                l.append(pair)
-        return l
+                    time.sleep(FETCH_POLL_INTERVAL)
+        finally:
+            if notifier is not None:
+                notifier.close()
 
     def fetch(self: FileHandler, round_nb: int) -> None:
-        for pair in self.get_pairing(round_nb):
-            self.db.add_players(pair, round_nb)
+        """Bring the stored round up to date with its document, in a single transaction: new boards are inserted,
+        boards no longer in it are flagged as removed unless they were already paired, and nothing else is written.
+        The document is not even read if its size and mtime did not change since the last import, nor parsed if its content did not.
+        Like git's "racily clean" files, the mtime of a document modified just before its import is not trusted"""
+        start = time.perf_counter()
+        known = self.db.get_round_file(round_nb)
+        with open(G_DOC_PATH.format(round_nb), "rb") as input_:
+            # Taken before reading, so that a write during the import makes the next call check the file again
+            stat = os.fstat(input_.fileno())
+            # Recorded as 0 when racy, which never matches
+            mtime_ns = stat.st_mtime_ns if time.time_ns() - stat.st_mtime_ns > RACY_MTIME_MARGIN * 10**9 else 0
+            if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+                log.info(f"Round {round_nb}, document unchanged since the last import")
+                return
+            content = input_.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if known is not None and known[2] == sha256:
+            self.db.set_round_file(round_nb, stat.st_size, mtime_ns, sha256)
+            log.info(f"Round {round_nb}, document touched but its content is unchanged since the last import")
+            return
+        stored = self.db.get_round_boards(round_nb)
+        parsed = dict.fromkeys(self.parse_pairing(content.decode().splitlines())) # ordered set
+        removed = []
+        for pair, (row_id, paired, was_removed) in stored.items():
+            if pair in parsed or was_removed:
+                continue
+            if paired:
+                log.warning(f"Board {row_id} {pair} is no longer in the document but was already paired, it is kept")
+            else:
+                removed.append(row_id)
+        restored = [stored[pair][0] for pair in parsed if pair in stored and stored[pair][2]]
+        with self.db.transaction():
+            nb_rows = self.db.add_players_many((pair for pair in parsed if pair not in stored), round_nb)
+            self.db.set_removed(removed, True)
+            self.db.set_removed(restored, False)
+            self.db.set_round_file(round_nb, stat.st_size, mtime_ns, sha256)
+        elapsed = time.perf_counter() - start
+        log.info(f"Round {round_nb}, {len(parsed)} boards read, {nb_rows} imported, {len(removed)} removed and {len(restored)} restored in {elapsed * 1000:.1f}ms ({len(parsed) / elapsed:.0f} rows/s)")
 
-@dataclass
+@dataclass(frozen=True)
 class Pair:
     white_player: str
     black_player: str
 
-class Pairing:
+class CircuitOpenError(Exception):
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+class CircuitBreaker:
+    """Fail fast when a host keeps failing, instead of piling up retries against it"""
+
+    def __init__(self: CircuitBreaker, host: str) -> None:
+        self.host = host
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def check(self: CircuitBreaker) -> None:
+        """Raise `CircuitOpenError` if the host is considered down.
+        After the cooldown, a single trial request is let through, whose result closes or re-opens the circuit"""
+        with self.lock:
+            if self.failures < BREAKER_THRESHOLD:
+                return
+            now = time.monotonic()
+            if now < self.open_until:
+                raise CircuitOpenError(f"{self.host} is down, circuit open for {self.open_until - now:.0f}s")
+            # Half-open: the other requests wait for the trial's result, or another cooldown if it never comes (eg a 429)
+            self.open_until = now + BREAKER_COOLDOWN
+            log.info(f"{self.host}, circuit half-open, sending a trial request")
+
+    def success(self: CircuitBreaker) -> None:
+        with self.lock:
+            self.failures = 0
+
+    def failure(self: CircuitBreaker) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                # Also re-opens it straight away when the trial request after the cooldown fails
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+                log.warning(f"{self.host} failed {self.failures} times in a row, circuit open for {BREAKER_COOLDOWN}s")
+
+class Retrier:
+    """Send requests, retrying idempotent ones on connection errors and `RETRY_STATUSES` until `deadline`.
+    Keep the number of retries and the total time slept, for the whole command"""
+
+    def __init__(self: Retrier, deadline: float = RETRY_DEADLINE) -> None:
+        self.deadline = deadline
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.slept = 0.0
+
+    def breaker(self: Retrier, url: str) -> CircuitBreaker:
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host)
+            return self.breakers[host]
+
+    def next_delay(self: Retrier, start: float, delay: float, headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        """Return the time to sleep before the next try, or `None` if it would exceed the deadline"""
+        delay = min(RETRY_CAP, random.uniform(RETRY_BASE, delay * 3))
+        try:
+            delay = max(delay, float((headers or {}).get("Retry-After", 0)))
+        except ValueError: # HTTP-date
+            pass
+        if time.monotonic() + delay - start > self.deadline:
+            return None
+        with self.lock:
+            self.retries += 1
+            self.slept += delay
+        return delay
+
+    def request(self: Retrier, http: requests.Session, method: str, url: str, idempotent: bool = True, **kwargs: Any) -> requests.Response:
+        """Same as `http.request`. The response of the last try is returned even if its status is in `RETRY_STATUSES`"""
+        breaker = self.breaker(url)
+        start = time.monotonic()
+        delay = RETRY_BASE
+        while True:
+            breaker.check()
+            try:
+                r = http.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                breaker.failure()
+                if not idempotent or (delay := self.next_delay(start, delay)) is None:
+                    raise
+                log.warning(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    breaker.success()
+                    return r
+                if r.status_code != 429: # the host is up, just busy
+                    breaker.failure()
+                if not idempotent or (delay := self.next_delay(start, delay, r.headers)) is None:
+                    return r
+                r.close()
+                log.warning(f"{method} {url} returned {r.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    async def arequest(self: Retrier, http: aiohttp.ClientSession, method: str, url: str, idempotent: bool = True, **kwargs: Any) -> aiohttp.ClientResponse:
+        """Asyncio version of `request`, the response must be released by the caller, eg with `async with`"""
+        breaker = self.breaker(url)
+        start = time.monotonic()
+        delay = RETRY_BASE
+        while True:
+            breaker.check()
+            try:
+                r = await http.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                breaker.failure()
+                if not idempotent or (delay := self.next_delay(start, delay)) is None:
+                    raise
+                log.warning(f"{method} {url} failed ({e!r}), retrying in {delay:.1f}s")
+            else:
+                if r.status not in RETRY_STATUSES:
+                    breaker.success()
+                    return r
+                if r.status != 429:
+                    breaker.failure()
+                if not idempotent or (delay := self.next_delay(start, delay, r.headers)) is None:
+                    return r
+                r.release()
+                log.warning(f"{method} {url} returned {r.status}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def report(self: Retrier) -> str:
+        return f"{self.retries} retries, {self.slept:.1f}s spent sleeping"
+
+class TokenBucket:
+    """Rate-limit state of one API token: `rate` requests per second, with bursts of up to `burst` requests"""
+
+    def __init__(self: TokenBucket, token: str, rate: float, burst: int) -> None:
+        self.headers = {**API_KEY, "Authorization": f"Bearer {token}"}
+        self.name = f"…{token[-4:]}" # they all start with `lip_`
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.sent = 0
+        self.rate_limited = 0
+
+    def available_in(self: TokenBucket, now: float) -> float:
+        """Refill the bucket, and return in how many seconds the next request can be sent"""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return max((1 - self.tokens) / self.rate, self.paused_until - now, 0)
+
+class RequestScheduler:
+    """Thread-safe scheduler spreading requests between the `TokenBucket` of every token in `tokens`.
+    Each request goes to the token which can send it first, preferring the ones rate-limited the least.
+    Rate-limited requests (429) pause their token for as long as the server asks, and must be sent again"""
+
+    def __init__(self: RequestScheduler, rate: float = CHALLENGE_RATE, burst: int = CHALLENGE_BURST, tokens: Optional[List[str]] = None) -> None:
+        self.rate = rate
+        self.buckets = [TokenBucket(token, rate, burst) for token in (tokens or TOKENS or [""])]
+        self.lock = threading.Lock()
+        self.first_sent: Optional[float] = None
+        self.sent = 0
+        self.rate_limited = 0
+
+    def wait(self: RequestScheduler) -> Tuple[float, TokenBucket]:
+        """Reserve a token, and return how long to wait in seconds before sending the request, and with which token"""
+        with self.lock:
+            now = time.monotonic()
+            delay, _, i = min((bucket.available_in(now), bucket.rate_limited, i) for i, bucket in enumerate(self.buckets))
+            bucket = self.buckets[i]
+            bucket.tokens -= 1
+            if self.first_sent is None:
+                self.first_sent = now + delay
+            return delay, bucket
+
+    def done(self: RequestScheduler, bucket: TokenBucket, status_code: int, headers: Mapping[str, str]) -> bool:
+        """Record a response, return `True` if the request was rate-limited and must be sent again"""
+        with self.lock:
+            self.sent += 1
+            bucket.sent += 1
+            if status_code != 429:
+                return False
+            self.rate_limited += 1
+            bucket.rate_limited += 1
+            try:
+                delay = float(headers.get("Retry-After", RATE_LIMIT_DELAY))
+            except ValueError: # HTTP-date
+                delay = RATE_LIMIT_DELAY
+            bucket.paused_until = max(bucket.paused_until, time.monotonic() + delay)
+            # No burst right after the pause
+            bucket.tokens = min(bucket.tokens, 0)
+        log.warning(f"Token {bucket.name} rate-limited, paused for {delay}s")
+        return True
+
+    def reserve_burst(self: RequestScheduler, nb_requests: int) -> List[TokenBucket]:
+        """Take up to `nb_requests` requests from the tokens' bursts, to be sent at once without waiting, and return the token of each"""
+        with self.lock:
+            now = time.monotonic()
+            reserved: List[TokenBucket] = []
+            while len(reserved) < nb_requests:
+                available = [bucket for bucket in self.buckets if bucket.available_in(now) == 0]
+                if not available:
+                    break
+                # Spread evenly between the tokens
+                for bucket in available[:nb_requests - len(reserved)]:
+                    bucket.tokens -= 1
+                    reserved.append(bucket)
+            return reserved
+
+    def send(self: RequestScheduler, request: Callable[[Dict[str, str]], requests.Response]) -> requests.Response:
+        """Call `request` with the headers of a token once its turn comes, again as long as it's rate-limited"""
+        while True:
+            delay, bucket = self.wait()
+            time.sleep(delay)
+            r = request(bucket.headers)
+            if not self.done(bucket, r.status_code, r.headers):
+                return r
+
+    def achieved_rate(self: RequestScheduler) -> float:
+        """Requests per second actually sent since the first one"""
+        if self.first_sent is None:
+            return 0.0
+        return self.sent / max(time.monotonic() - self.first_sent, 1e-9)
+
+    def report(self: RequestScheduler) -> str:
+        per_token = ", ".join(f"{bucket.name}: {bucket.sent} ({bucket.rate_limited} rate-limited)" for bucket in self.buckets)
+        return f"{self.sent} requests at {self.achieved_rate():.2f}/s (limit {self.rate * len(self.buckets)}/s), {self.rate_limited} rate-limited [{per_token}]"
+
+class Http2Response:
+    """Wrap a `httpx.Response` with the parts of the `requests.Response` interface used by `Pairing`"""
+
+    def __init__(self: Http2Response, session: Http2Session, r: httpx.Response) -> None:
+        self.session = session
+        self.r = r
+        self.status_code = r.status_code
+        self.headers = r.headers
+
+    def __enter__(self: Http2Response) -> Http2Response:
+        return self
+
+    def __exit__(self: Http2Response, *exc_info: Any) -> None:
+        self.close()
+
+    @property
+    def content(self: Http2Response) -> bytes:
+        return self.session.run(self.r.aread())
+
+    @property
+    def text(self: Http2Response) -> str:
+        self.content # read the body first if it's streamed
+        return self.r.text
+
+    def json(self: Http2Response) -> Any:
+        return json.loads(self.content)
+
+    def iter_lines(self: Http2Response) -> Iterator[str]:
+        lines = self.r.aiter_lines()
+        while True:
+            try:
+                yield self.session.run(lines.__anext__())
+            except StopAsyncIteration:
+                return
+
+    def raise_for_status(self: Http2Response) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.r.url}", response=self)
+
+    def close(self: Http2Response) -> None:
+        self.session.run(self.r.aclose())
+
+class Http2Session:
+    """HTTP/2 transport for `Pairing`, with the parts of the `requests.Session` interface it uses.
+    All requests to lichess are multiplexed over a single connection. Errors are raised as their `requests` counterpart"""
+
+    def __init__(self: Http2Session) -> None:
+        # httpx' sync HTTP/2 connections can't be shared between threads, so the async client runs in its own
+        # event loop, and the workers submit their requests to it.
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        # Without TLS there's no ALPN to negotiate HTTP/2, so the local server is assumed to speak it directly
+        self.client = httpx.AsyncClient(http2=True, http1=BASE.startswith("https://"))
+
+    def run(self: Http2Session, coro: Any) -> Any:
+        """Run `coro` in the transport's event loop and return its result, raising `httpx` errors as `requests` ones"""
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e)
+
+    def request(self: Http2Session, method: str, url: str, stream: bool = False, timeout: Any = None, **kwargs: Any) -> Http2Response:
+        # Unlike `requests`, httpx only takes form fields as `data`, raw bodies are `content`
+        if "data" in kwargs and not isinstance(kwargs["data"], Mapping):
+            kwargs["content"] = kwargs.pop("data")
+        return self.send(self.client.build_request(method, url, **kwargs), stream=stream, timeout=timeout)
 
-    def __init__(self: Pairing, db: Db) -> None:
+    def head(self: Http2Session, url: str, **kwargs: Any) -> Http2Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def prepare_request(self: Http2Session, request: requests.Request) -> httpx.Request:
+        return self.client.build_request(request.method, request.url, data=request.data, headers=request.headers)
+
+    def send(self: Http2Session, request: httpx.Request, stream: bool = False, timeout: Any = None) -> Http2Response:
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            request.extensions["timeout"] = httpx.Timeout(None, connect=connect, read=read).as_dict()
+        return Http2Response(self, self.run(self.client.send(request, stream=stream)))
+
+    def mount(self: Http2Session, prefix: str, adapter: HTTPAdapter) -> None:
+        """No-op, a single connection is enough for any number of concurrent requests"""
+
+class RoundDeadline:
+    """Stop creating challenges once the round can no longer be started within `deadline` seconds.
+    Expects `db`, `timeout`, `deadline`, `deadline_at` and `latency` attributes"""
+
+    def start_deadline(self: RoundDeadline) -> None:
+        self.deadline_at = None if self.deadline is None else time.monotonic() + self.deadline
+
+    def request_timeout(self: RoundDeadline) -> Tuple[float, float]:
+        """Return the timeout of the next challenge, shortened to end before the round deadline.
+        Raise `DeadlineExceeded` when a challenge would not have the time to complete anymore"""
+        if self.deadline_at is None:
+            return self.timeout
+        remaining = self.deadline_at - time.monotonic()
+        if remaining <= self.latency:
+            raise DeadlineExceeded()
+        return (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+
+    def save_challenges(self: RoundDeadline, ids: List[Tuple[int, str]], unsent: List[int]) -> None:
+        """Save the game ids created, and forget the challenges that created no game: cut off by the deadline before being sent,
+        or refused by lichess. In a single transaction"""
+        with self.db.transaction():
+            self.db.add_lichess_game_ids(ids)
+            self.db.clear_sent(unsent)
+
+    def report_pending(self: RoundDeadline, round_nb: int) -> None:
+        pending = self.db.get_unpaired_players(round_nb)
+        if pending:
+            log.warning(f"Round {round_nb}, {len(pending)} boards still pending: {', '.join(f'{row_id} ({pair.white_player}-{pair.black_player})' for row_id, pair in pending)}")
+
+class Pairing(RoundDeadline):
+
+    def __init__(
+        self: Pairing,
+        db: Db,
+        concurrency: int = PAIRING_CONCURRENCY,
+        scheduler: Optional[RequestScheduler] = None,
+        timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        deadline: Optional[float] = None,
+        transport: str = "http1",
+        ) -> None:
+        """`timeout` is the `(connect, read)` timeout of every request, `deadline` the maximum number of seconds for creating a round.
+        `transport` is either `http1` (`requests`, one connection per request in flight) or `http2` (`httpx`, one multiplexed connection)"""
         self.db = db
-        http = requests.Session()
-        http.mount("https://", ADAPTER)
-        http.mount("http://", ADAPTER)
-        self.http = http
+        self.concurrency = concurrency
+        self.scheduler = scheduler or RequestScheduler()
+        self.retrier = Retrier()
+        self.timeout = timeout
+        self.deadline = deadline
+        self.deadline_at: Optional[float] = None
+        self.latency = 0.0 # moving average of the challenges' latency
+        self.http: Union[requests.Session, Http2Session] = Http2Session() if transport == "http2" else requests.Session()
+        self.size_pool(concurrency)
         self.dep = time.time()
 
+    def size_pool(self: Pairing, pool_size: int) -> None:
+        """Keep up to `pool_size` connections, one per worker so none has to wait for another or open a throwaway connection"""
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
     def tl(self: Pairing) -> float:
         """time elapsed"""
         return time.time() - self.dep
 
     def pair_all_players(self: Pairing, round_nb: int) -> None:
-        for row_id, pair in self.db.get_unpaired_players(round_nb):
-            game_id = self.create_game(pair)
-            self.db.add_lichess_game_id(row_id, game_id)
+        # Challenges are created by a pool of workers sharing `self.http`, but sqlite objects can only be used
+        # in the thread that created them, so game ids are written from the main thread as they come back.
+        # They are committed by batches of `self.concurrency`, and whatever was created is saved even if a worker fails.
+        # Boards are journaled as sent by batches too, just before being submitted, so that at most
+        # `2 * self.concurrency` of them are in doubt if the run crashes. The ones cut off by the deadline or refused are removed from it
+        unpaired = self.resume(round_nb)
+        self.prewarm(min(self.concurrency, len(unpaired)))
+        self.start_deadline()
+        ids: List[Tuple[int, str]] = []
+        unsent: List[int] = []
+        futures: Dict[Future[str], Tuple[int, Pair]] = {}
+        next_board = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            def submit_batch() -> None:
+                nonlocal next_board
+                batch = unpaired[next_board:next_board + self.concurrency]
+                if not batch:
+                    return
+                next_board += len(batch)
+                self.db.mark_sent([row_id for row_id, _ in batch])
+                for row_id, pair in batch:
+                    futures[executor.submit(self.create_game, pair)] = (row_id, pair)
+            try:
+                submit_batch()
+                while futures:
+                    if len(futures) <= self.concurrency:
+                        submit_batch()
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        row_id, pair = futures.pop(future)
+                        try:
+                            ids.append((row_id, future.result()))
+                        except DeadlineExceeded:
+                            unsent.append(row_id)
+                        except Exception as e:
+                            log.error(f"Board {row_id} {pair}, challenge failed: {e!r}")
+                            if refused(e): # no game was created
+                                unsent.append(row_id)
+                    if len(ids) + len(unsent) >= self.concurrency:
+                        self.save_challenges(ids, unsent)
+                        ids, unsent = [], []
+            finally:
+                self.save_challenges(ids, unsent)
+        log.info(f"Round {round_nb}, {len(unpaired)} games to create in {self.tl():.2f}s, {self.scheduler.report()}")
+        self.report_pending(round_nb)
 
-    def create_game(self: Pairing, pair: Pair) -> str:
-        """Return the lichess game id of the game created"""
-        url = PAIRING_API.format(pair.white_player, pair.black_player)
+    def resume(self: Pairing, round_nb: int) -> List[Tuple[int, Pair]]:
+        """Settle the challenges a previous run sent but never confirmed, by looking for their games all at once,
+        and return the boards left to pair. Boards that could not be checked are left out, rather than risking a second game"""
+        unconfirmed = self.db.get_unconfirmed_challenges(round_nb)
+        if not unconfirmed:
+            return self.db.get_boards_to_pair(round_nb, skip=set())
+        ids: List[Tuple[int, str]] = []
+        in_doubt: Set[int] = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.find_game, pair, sent_at): (row_id, pair) for row_id, pair, sent_at in unconfirmed}
+            for future in as_completed(futures):
+                row_id, pair = futures[future]
+                try:
+                    game_id = future.result()
+                except Exception as e:
+                    log.error(f"Board {row_id} {pair}, could not check whether its challenge was created: {e!r}")
+                    in_doubt.add(row_id)
+                    continue
+                if game_id is not None:
+                    ids.append((row_id, game_id))
+        self.db.add_lichess_game_ids(ids)
+        log.info(f"Round {round_nb}, {len(unconfirmed)} challenges of a previous run unconfirmed: {len(ids)} games found, {len(in_doubt)} boards left in doubt, in {self.tl():.2f}s")
+        return self.db.get_boards_to_pair(round_nb, skip=in_doubt)
+
+    def prewarm(self: Pairing, nb_connections: int) -> None:
+        """Open `nb_connections` keep-alive connections to lichess, so no challenge pays for the DNS, TCP and TLS setup"""
+        if isinstance(self.http, Http2Session):
+            nb_connections = min(nb_connections, 1) # all requests share it
+        if nb_connections <= 0:
+            return
+        # Responses are streamed so each one holds its connection until all the others are opened too,
+        # then reading the (empty) body gives them back to the pool.
+        barrier = threading.Barrier(nb_connections)
+        def open_connection() -> None:
+            try:
+                r = self.http.head(BASE, stream=True, timeout=self.timeout)
+            except requests.RequestException:
+                barrier.abort() # the others would wait for this connection until they time out
+                raise
+            try:
+                barrier.wait(timeout=self.timeout[0] + self.timeout[1])
+            except threading.BrokenBarrierError: # another one failed, this connection is open all the same
+                pass
+            finally:
+                r.content
+        start = time.monotonic()
+        opened = 0
+        with ThreadPoolExecutor(max_workers=nb_connections) as executor:
+            for future in [executor.submit(open_connection) for _ in range(nb_connections)]:
+                try:
+                    future.result()
+                    opened += 1
+                except requests.RequestException as e:
+                    log.warning(f"Pre-warming a connection failed: {e!r}")
+        log.info(f"{opened}/{nb_connections} connections to {BASE} opened in {time.monotonic() - start:.2f}s")
+
+    def scheduled_pair_all_players(self: Pairing, round_nb: int, at: datetime) -> None:
+        """Create all the games of the round in a single burst at `at`, so that every board starts at the same time.
+        Everything that can be is done beforehand: loading the boards, preparing the requests and, `PREWARM_LEAD` seconds before,
+        opening one connection per board. The burst is limited by the tokens' `--burst`, the boards left are created afterwards at `--rate`.
+        `--deadline` starts with the burst"""
+        unpaired = self.resume(round_nb)
+        if not unpaired:
+            return
+        buckets = self.scheduler.reserve_burst(len(unpaired))
+        if len(buckets) < len(unpaired):
+            log.warning(f"Round {round_nb}, the tokens allow a burst of {len(buckets)} challenges, the {len(unpaired) - len(buckets)} other boards will start later")
+        requests_ = [self.http.prepare_request(requests.Request(
+            "POST",
+            PAIRING_API.format(pair.white_player, pair.black_player),
+            data=CHALLENGE_PAYLOAD,
+            headers=bucket.headers,
+            )) for (_, pair), bucket in zip(unpaired, buckets)]
+        nb_workers = max(len(buckets), 1)
+        self.size_pool(nb_workers)
+        go = threading.Event()
+        sent_at: List[float] = [0.0] * len(buckets)
+        def send(i: int) -> str:
+            go.wait()
+            if i >= len(buckets):
+                return self.create_game(unpaired[i][1])
+            def send_first() -> requests.Response:
+                sent_at[i] = self.tl()
+                r = self.http.send(requests_[i], timeout=self.timeout)
+                self.scheduler.done(buckets[i], r.status_code, r.headers)
+                return r
+            # Failures go through the same retries as any other challenge
+            return self.create_game(unpaired[i][1], send_first)
+        ids: List[Tuple[int, str]] = []
+        unsent: List[int] = []
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            futures = {executor.submit(send, i): i for i in range(len(unpaired))}
+            log.info(f"Round {round_nb}, {len(unpaired)} challenges ready, starting at {at:%H:%M:%S}")
+            # Idle connections end up closed by the server, so they're only opened just before the burst
+            time.sleep(max(at.timestamp() - PREWARM_LEAD - time.time(), 0))
+            self.prewarm(len(buckets))
+            delay = at.timestamp() - time.time()
+            if delay < 0:
+                log.warning(f"Round {round_nb}, {at:%H:%M:%S} already passed by {-delay:.1f}s, starting now")
+            else:
+                # `time.sleep` can overshoot by a few ms, so the last moments are spent spinning
+                time.sleep(max(delay - 0.05, 0))
+                while time.time() < at.timestamp():
+                    pass
+            self.db.mark_sent([row_id for row_id, _ in unpaired])
+            self.start_deadline()
+            go.set()
+            for future in as_completed(futures):
+                row_id, pair = unpaired[futures[future]]
+                try:
+                    ids.append((row_id, future.result()))
+                except DeadlineExceeded:
+                    unsent.append(row_id)
+                except Exception as e:
+                    log.error(f"Board {row_id} {pair}, challenge failed: {e!r}")
+                    if refused(e): # no game was created
+                        unsent.append(row_id)
+        self.save_challenges(ids, unsent)
+        sent = [t for t in sent_at if t] or [self.tl()]
+        log.info(f"Round {round_nb}, {len(ids)} games created, burst of {len(buckets)} challenges sent within {(max(sent) - min(sent)) * 1000:.1f}ms, last game created after {self.tl() - min(sent):.2f}s")
+        self.report_pending(round_nb)
+
+    def bulk_pair_all_players(self: Pairing, round_nb: int) -> None:
+        """Create all the games of the round with a single call to the bulk pairing API"""
+        unpaired = self.resume(round_nb)
+        if not unpaired:
+            return
+        with open(PLAYER_TOKENS_PATH) as input_:
+            tokens = {username.lower(): token for username, token in json.load(input_).items()}
+        missing = sorted({player for _, pair in unpaired for player in (pair.white_player, pair.black_player) if player.lower() not in tokens})
+        if missing:
+            raise ValueError(f"Round {round_nb}, no token in {PLAYER_TOKENS_PATH} for {', '.join(missing)}")
         payload = {
+            "players": ",".join(f"{tokens[pair.white_player.lower()]}:{tokens[pair.black_player.lower()]}" for _, pair in unpaired),
             "rated": "true",
-            "clock.limit": 600,
-            "clock.increment": 2,
-            "color": "white"
+            **CLOCK,
         }
-        r = self.http.post(url, data=payload, headers=API_KEY)
+        row_ids = [row_id for row_id, _ in unpaired]
+        self.db.mark_sent(row_ids)
+        r = self.retrier.request(self.http, "POST", BULK_PAIRING_API, idempotent=False, data=payload, headers=API_KEY, timeout=self.timeout)
+        if 400 <= r.status_code < 500: # refused, eg an invalid token, no game was created
+            log.error(f"Round {round_nb}, bulk pairing refused: {r.text}")
+            self.db.clear_sent(row_ids)
+        r.raise_for_status()
         rep = r.json()
         log.debug(rep)
-        return rep["game"]["id"]
+        # Lichess returns user ids, which are lowercased usernames
+        games = {(game["white"], game["black"]): game["id"] for game in rep["games"]}
+        ids = [(row_id, games[(pair.white_player.lower(), pair.black_player.lower())]) for row_id, pair in unpaired]
+        self.db.add_lichess_game_ids(ids)
+        log.info(f"Round {round_nb}, {len(ids)} games created in {self.tl():.2f}s")
+
+    def create_game(self: Pairing, pair: Pair, send_first: Optional[Callable[[], requests.Response]] = None) -> str:
+        """Return the lichess game id of the game created. `send_first` sends the first challenge instead of the scheduler, eg a prepared request"""
+        url = PAIRING_API.format(pair.white_player, pair.black_player)
+        payload = CHALLENGE_PAYLOAD
+        def send(headers: Dict[str, str]) -> requests.Response:
+            timeout = self.request_timeout()
+            start = time.monotonic()
+            r = self.retrier.request(self.http, "POST", url, idempotent=False, data=payload, headers=headers, timeout=timeout)
+            self.latency = 0.8 * self.latency + 0.2 * (time.monotonic() - start)
+            return r
+        first_try = time.time()
+        start = time.monotonic()
+        delay = RETRY_BASE
+        error: Optional[Exception] = None
+        while True:
+            try:
+                first, send_first = send_first, None
+                if first is None:
+                    self.request_timeout() # don't wait for our turn if the deadline already passed
+                r = first() if first is not None else self.scheduler.send(send)
+                if r.status_code == 429: # not created, the scheduler already paused its token
+                    continue
+                if r.status_code < 500:
+                    if r.status_code >= 400: # refused, eg a closed account, sending it again won't help
+                        raise requests.HTTPError(f"{r.status_code} Error for url: {url}: {r.text}", response=r)
+                    rep = r.json()
+                    log.debug(rep)
+                    return rep["game"]["id"]
+                error = requests.HTTPError(f"{r.status_code} Error for url: {url}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except DeadlineExceeded:
+                # Only means the challenge was never sent if no previous try may have created it
+                if error is None:
+                    raise
+                raise error
+            # The challenge may have been created even though we got no answer, so it's only sent again if no game was found
+            if (delay := self.retrier.next_delay(start, delay)) is None:
+                raise error
+            log.warning(f"{pair}, challenge failed ({error!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            game_id = self.find_game(pair, first_try)
+            if game_id is not None:
+                log.info(f"{pair}, adopting game {game_id} created by a previous try")
+                return game_id
+
+    def find_game(self: Pairing, pair: Pair, since: float) -> Optional[str]:
+        """Return the id of a game between the two players, with the same colours, created after the `since` timestamp"""
+        params = {"vs": pair.black_player, "since": int((since - RECONCILE_MARGIN) * 1000), "ongoing": "true", "moves": "false"}
+        with self.retrier.request(self.http, "GET", GAMES_BY_USER_API.format(pair.white_player), params=params, headers=API_KEY, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line: # keep-alive
+                    continue
+                game = json.loads(line)
+                if game["players"]["white"].get("user", {}).get("id") == pair.white_player.lower():
+                    return game["id"]
+        return None
 
-    def check_all_results(self: Pairing, round_nb: int) -> None:
+    def validate_players(self: Pairing, round_nb: int) -> int:
+        """Check the lichess accounts of the players of the round not validated recently, with one request per `USERS_CHUNK_SIZE` of them.
+        Return the number of boards that can't be paired"""
+        usernames = self.db.get_unchecked_players(round_nb)
+        def check_chunk(chunk: List[str]) -> List[Tuple[str, Optional[str]]]:
+            r = self.retrier.request(self.http, "POST", USERS_API, data=",".join(chunk), headers=API_KEY, timeout=self.timeout)
+            r.raise_for_status()
+            # Unknown usernames are left out of the answer
+            users = {user["id"]: user for user in r.json()}
+            return [(username, self.account_problem(users.get(username))) for username in chunk]
+        checks: List[Tuple[str, Optional[str]]] = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for chunk_checks in executor.map(check_chunk, chunks(usernames, USERS_CHUNK_SIZE)):
+                checks.extend(chunk_checks)
+        self.db.add_player_checks(checks)
+        invalid = self.db.get_invalid_boards(round_nb)
+        for row_id, reason in invalid.items():
+            log.error(f"Board {row_id}: {reason}")
+        log.info(f"Round {round_nb}, {len(checks)} players checked in {self.tl():.2f}s, {len(invalid)} boards can't be paired")
+        return len(invalid)
+
+    @staticmethod
+    def account_problem(user: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Return why a lichess account can't be paired, `None` if it can"""
+        if user is None:
+            return "does not exist"
+        if user.get("disabled"):
+            return "is closed"
+        if user.get("tosViolation"):
+            return "violated the terms of service"
+        return None
+
+    def check_all_results(self: Pairing, round_nb: int) -> int:
+        """Save the results of the games which ended since the last call, and return the number of games still running"""
         games_dic = self.db.get_unfinished_games(round_nb)
-        # Not streaming since at most 128 games so ~6s and it avoid parsing ndjson.
-        r = self.http.post(LOOKUP_API, data=",".join(games_dic.keys()), headers=API_KEY, params={"moves": "false"})
-        games = r.text.split('\n')[:-1]
-        log.debug(games)
-        for raw_game in games:
-            log.debug(raw_game)
-            game = json.loads(raw_game)
+        finished = 0
+        # The workers stream their chunk of the export into `games_queue`, followed by `None` once done,
+        # and the main thread saves the games as they come, since it's the only one allowed to use the db.
+        games_queue: queue.Queue[Optional[Dict[str, Any]]] = queue.Queue()
+        def export_chunk(chunk: List[str]) -> None:
+            try:
+                for game in self.export_games(chunk):
+                    games_queue.put(game)
+            finally:
+                games_queue.put(None)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(export_chunk, chunk) for chunk in chunks(list(games_dic), LOOKUP_CHUNK_SIZE)]
+            results = []
+            chunks_left = len(futures)
+            while chunks_left:
+                game = games_queue.get()
+                if game is None:
+                    chunks_left -= 1
+                else:
+                    result = self.return_result_int(game)
+                    id_ = game["id"]
+                    log.info(f"Game {id_}, result: {result}")
+                    if result is not None:
+                        results.append((games_dic[id_], result))
+                if len(results) >= RESULT_BATCH_SIZE or (game is None and results):
+                    self.db.add_game_results(results)
+                    finished += len(results)
+                    results = []
+            for future in futures:
+                future.result() # re-raise exceptions from the workers
+        log.info(f"Round {round_nb}, {finished} games finished, {len(games_dic) - finished} still running")
+        return len(games_dic) - finished
+
+    def watch_results(self: Pairing, round_nb: int) -> None:
+        """Save the result of every unfinished game of the round as soon as it ends, returns once they're all finished"""
+        games_dic = self.db.get_unfinished_games(round_nb)
+        games_queue: queue.Queue[Optional[Dict[str, Any]]] = queue.Queue()
+        threads = [threading.Thread(target=self.watch_games, args=(chunk, games_queue), daemon=True) for chunk in chunks(list(games_dic), WATCH_CHUNK_SIZE)]
+        for thread in threads:
+            thread.start()
+        log.info(f"Round {round_nb}, watching {len(games_dic)} games with {len(threads)} streams")
+        streams_left = len(threads)
+        while streams_left:
+            game = games_queue.get()
+            if game is None:
+                streams_left -= 1
+                continue
             result = self.return_result_int(game)
             id_ = game["id"]
-            log.info(f"Game {id_}, result: {result}")
-            self.db.add_game_result(id_, result)
+            log.info(f"Game {id_}, result: {result}, {self.tl():.0f}s")
+            self.db.add_game_result(games_dic[id_], result)
+
+    def watch_games(self: Pairing, game_ids: List[str], games_queue: queue.Queue[Optional[Dict[str, Any]]]) -> None:
+        """Put every game of `game_ids` in `games_queue` once it's finished, then `None`.
+        When the connection drops or stays silent, it is reopened for the games still running only"""
+        stream_id = os.urandom(6).hex()
+        running = set(game_ids)
+        try:
+            while running:
+                try:
+                    with self.retrier.request(self.http, "POST", WATCH_API.format(stream_id), data=",".join(running), headers=API_KEY, stream=True, timeout=(self.timeout[0], WATCH_READ_TIMEOUT)) as r:
+                        r.raise_for_status()
+                        for line in r.iter_lines():
+                            if not line: # keep-alive
+                                continue
+                            log.debug(line)
+                            game = json.loads(line)
+                            if game["id"] in running and self.return_result_int(game) is not None:
+                                running.discard(game["id"])
+                                games_queue.put(game)
+                            if not running:
+                                break
+                # `ValueError` for a line truncated by the disconnection
+                except (requests.RequestException, CircuitOpenError, ValueError) as e:
+                    log.warning(f"Stream {stream_id} interrupted: {e!r}")
+                if running:
+                    log.info(f"Stream {stream_id}, reconnecting for {len(running)} games in {WATCH_RECONNECT_DELAY}s")
+                    time.sleep(WATCH_RECONNECT_DELAY)
+        except Exception as e:
+            log.error(f"Stream {stream_id} failed with {len(running)} games still running: {e!r}")
+            raise
+        finally:
+            # Even if the thread dies, so that `watch_results` doesn't wait for it forever
+            games_queue.put(None)
 
-    def return_result_int(self: Pairing, game: Dic[str, str]) -> Union[int, None]:
+    def export_games(self: Pairing, game_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """Yield the games one by one as lichess streams them, without waiting for the whole export"""
+        with self.retrier.request(self.http, "POST", LOOKUP_API, data=",".join(game_ids), headers=API_KEY, params={"moves": "false"}, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line: # keep-alive
+                    continue
+                log.debug(line)
+                yield json.loads(line)
+
+    @staticmethod
+    def return_result_int(game: Dict[str, Any]) -> Optional[int]:
+        """Return the result as stored in `rounds.result`, or `None` if the game is still running"""
         winner = game.get("winner")
-        status = game["status"]
+        # Game streams give the status id in `status` and its name in `statusName`
+        status = game.get("statusName", game["status"])
+        status = STATUS_NAMES.get(status, status)
+        if status not in GAME_STATUSES:
+            log.warning(f"Game {game['id']}, unknown status {status}, considered as still running")
+            return None
+        result = GAME_STATUSES[status]
+        if result is None:
+            return None
         if winner == "white":
             return 1
         elif winner == "black":
             return 0
-        elif winner is None and status == "draw" or status == "stalemate":
-            return 2
-        return None
+        return result
 
     def test(self):
         games_id = ["11tHUbnm", "ETSYCv5R", "KVPzep34", "uXxcDewp"]
-        # Not streaming since at most 128 games so ~6s and it avoid parsing ndjson.
-        r = self.http.post(LOOKUP_API, data=",".join(games_id), headers=API_KEY, params={"moves": "false"})
-        games = r.text.split('\n')[:-1]
-        log.debug(games)
-        for raw_game in games:
-            log.debug(raw_game)
-            game = json.loads(raw_game)
+        for game in self.export_games(games_id):
             result = self.return_result_int(game)
             id_ = game["id"]
             log.info(f"Game {id_}, result: {result}")  
 
+class AsyncPairing(RoundDeadline):
+    """Asyncio counterpart of `Pairing`, to be used as `async with AsyncPairing(db) as p:`.
+    At most `concurrency` requests are in flight at the same time, all sharing the same connection pool"""
+
+    def __init__(
+        self: AsyncPairing,
+        db: Db,
+        concurrency: int = PAIRING_CONCURRENCY,
+        scheduler: Optional[RequestScheduler] = None,
+        timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+        deadline: Optional[float] = None,
+        ) -> None:
+        self.db = db
+        self.concurrency = concurrency
+        self.scheduler = scheduler or RequestScheduler()
+        self.retrier = Retrier()
+        self.timeout = timeout
+        self.deadline = deadline
+        self.deadline_at: Optional[float] = None
+        self.latency = 0.0
+        self.dep = time.time()
+
+    async def __aenter__(self: AsyncPairing) -> AsyncPairing:
+        self.sem = asyncio.Semaphore(self.concurrency)
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT),
+            headers=API_KEY,
+            timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+        )
+        return self
 
+    async def __aexit__(self: AsyncPairing, *exc_info: Any) -> None:
+        await self.http.close()
+
+    def tl(self: AsyncPairing) -> float:
+        """time elapsed"""
+        return time.time() - self.dep
+
+    async def pair_all_players(self: AsyncPairing, round_nb: int) -> None:
+        unpaired = await self.resume(round_nb)
+        await self.prewarm(min(self.concurrency, len(unpaired)))
+        self.start_deadline()
+        # Everything runs in the event loop's thread, so the db can be written directly, by batches of `self.concurrency`.
+        # Boards are journaled as sent by batches too, just before being started, so that at most `2 * self.concurrency`
+        # of them are in doubt if the run crashes. The ones cut off by the deadline or refused are removed from it
+        ids: List[Tuple[int, str]] = []
+        unsent: List[int] = []
+        async def pair_one(row_id: int, pair: Pair) -> None:
+            nonlocal ids, unsent
+            try:
+                game_id = await self.create_game(pair) # before `ids`, which may be replaced in the meantime
+            except DeadlineExceeded:
+                unsent.append(row_id)
+            except Exception as e:
+                log.error(f"Board {row_id} {pair}, challenge failed: {e!r}")
+                if refused(e): # no game was created
+                    unsent.append(row_id)
+            else:
+                ids.append((row_id, game_id))
+            if len(ids) + len(unsent) >= self.concurrency:
+                self.save_challenges(ids, unsent)
+                ids, unsent = [], []
+        pending: Set[asyncio.Task[None]] = set()
+        try:
+            for i in range(0, len(unpaired), self.concurrency):
+                while len(pending) > self.concurrency:
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                batch = unpaired[i:i + self.concurrency]
+                self.db.mark_sent([row_id for row_id, _ in batch])
+                pending |= {asyncio.create_task(pair_one(row_id, pair)) for row_id, pair in batch}
+            await asyncio.gather(*pending)
+        finally:
+            self.save_challenges(ids, unsent)
+        log.info(f"Round {round_nb}, {len(unpaired)} games to create in {self.tl():.2f}s, {self.scheduler.report()}")
+        self.report_pending(round_nb)
+
+    async def resume(self: AsyncPairing, round_nb: int) -> List[Tuple[int, Pair]]:
+        """Settle the challenges a previous run sent but never confirmed, by looking for their games all at once,
+        and return the boards left to pair. Boards that could not be checked are left out, rather than risking a second game"""
+        unconfirmed = self.db.get_unconfirmed_challenges(round_nb)
+        if not unconfirmed:
+            return self.db.get_boards_to_pair(round_nb, skip=set())
+        async def find_one(pair: Pair, sent_at: float) -> Optional[str]:
+            async with self.sem:
+                return await self.find_game(pair, sent_at)
+        ids: List[Tuple[int, str]] = []
+        in_doubt: Set[int] = set()
+        results = await asyncio.gather(*(find_one(pair, sent_at) for _, pair, sent_at in unconfirmed), return_exceptions=True)
+        for (row_id, pair, _), game_id in zip(unconfirmed, results):
+            if isinstance(game_id, Exception):
+                log.error(f"Board {row_id} {pair}, could not check whether its challenge was created: {game_id!r}")
+                in_doubt.add(row_id)
+            elif game_id is not None:
+                ids.append((row_id, game_id))
+        self.db.add_lichess_game_ids(ids)
+        log.info(f"Round {round_nb}, {len(unconfirmed)} challenges of a previous run unconfirmed: {len(ids)} games found, {len(in_doubt)} boards left in doubt, in {self.tl():.2f}s")
+        return self.db.get_boards_to_pair(round_nb, skip=in_doubt)
+
+    async def prewarm(self: AsyncPairing, nb_connections: int) -> None:
+        """Open `nb_connections` keep-alive connections to lichess, so no challenge pays for the DNS, TCP and TLS setup"""
+        if nb_connections <= 0:
+            return
+        # Each response holds its connection until all of them are opened or failed, then they're released to the connector's pool
+        all_settled = asyncio.Event()
+        opened = failed = 0
+        def settle() -> None:
+            if opened + failed == nb_connections:
+                all_settled.set()
+        async def open_connection() -> None:
+            nonlocal opened, failed
+            try:
+                r = await self.http.head(BASE)
+            except Exception:
+                failed += 1 # the others must not wait for this connection until they time out
+                settle()
+                raise
+            async with r:
+                opened += 1
+                settle()
+                await asyncio.wait_for(all_settled.wait(), timeout=sum(self.timeout))
+        start = time.monotonic()
+        for result in await asyncio.gather(*(open_connection() for _ in range(nb_connections)), return_exceptions=True):
+            if isinstance(result, Exception):
+                log.warning(f"Pre-warming a connection failed: {result!r}")
+        log.info(f"{opened}/{nb_connections} connections to {BASE} opened in {time.monotonic() - start:.2f}s")
+
+    async def create_game(self: AsyncPairing, pair: Pair) -> str:
+        """Return the lichess game id of the game created"""
+        url = PAIRING_API.format(pair.white_player, pair.black_player)
+        payload = CHALLENGE_PAYLOAD
+        first_try = time.time()
+        first_start = time.monotonic()
+        retry_delay = RETRY_BASE
+        error: Optional[Exception] = None
+        async with self.sem:
+            while True:
+                try:
+                    self.request_timeout() # don't wait for our turn if the deadline already passed
+                    delay, bucket = self.scheduler.wait()
+                    await asyncio.sleep(delay)
+                    connect, read = self.request_timeout()
+                except DeadlineExceeded:
+                    # Only means the challenge was never sent if no previous try may have created it
+                    if error is None:
+                        raise
+                    raise error
+                start = time.monotonic()
+                try:
+                    async with await self.retrier.arequest(self.http, "POST", url, idempotent=False, data=payload, headers=bucket.headers, timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)) as r:
+                        if self.scheduler.done(bucket, r.status, r.headers):
+                            continue
+                        if r.status < 500:
+                            if r.status >= 400: # refused, eg a closed account, sending it again won't help
+                                raise response_error(r, await r.text())
+                            rep = await r.json(content_type=None)
+                            self.latency = 0.8 * self.latency + 0.2 * (time.monotonic() - start)
+                            break
+                        error = response_error(r)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    error = e
+                # The challenge may have been created even though we got no answer, so it's only sent again if no game was found
+                if (retry_delay := self.retrier.next_delay(first_start, retry_delay)) is None:
+                    raise error
+                log.warning(f"{pair}, challenge failed ({error!r}), retrying in {retry_delay:.1f}s")
+                await asyncio.sleep(retry_delay)
+                game_id = await self.find_game(pair, first_try)
+                if game_id is not None:
+                    log.info(f"{pair}, adopting game {game_id} created by a previous try")
+                    return game_id
+        log.debug(rep)
+        return rep["game"]["id"]
+
+    async def find_game(self: AsyncPairing, pair: Pair, since: float) -> Optional[str]:
+        """Return the id of a game between the two players, with the same colours, created after the `since` timestamp"""
+        params = {"vs": pair.black_player, "since": int((since - RECONCILE_MARGIN) * 1000), "ongoing": "true", "moves": "false"}
+        async with await self.retrier.arequest(self.http, "GET", GAMES_BY_USER_API.format(pair.white_player), params=params) as r:
+            r.raise_for_status()
+            async for line in r.content:
+                line = line.strip()
+                if not line: # keep-alive
+                    continue
+                game = json.loads(line)
+                if game["players"]["white"].get("user", {}).get("id") == pair.white_player.lower():
+                    return game["id"]
+        return None
+
+    async def check_all_results(self: AsyncPairing, round_nb: int) -> int:
+        """Save the results of the games which ended since the last call, and return the number of games still running"""
+        games_dic = self.db.get_unfinished_games(round_nb)
+        finished = 0
+        async def export_chunk(chunk: List[str]) -> None:
+            nonlocal finished
+            results = []
+            async for game in self.export_games(chunk):
+                result = Pairing.return_result_int(game)
+                id_ = game["id"]
+                log.info(f"Game {id_}, result: {result}")
+                if result is not None:
+                    results.append((games_dic[id_], result))
+                if len(results) >= RESULT_BATCH_SIZE:
+                    self.db.add_game_results(results)
+                    finished += len(results)
+                    results = []
+            self.db.add_game_results(results)
+            finished += len(results)
+        # A failed chunk doesn't stop the others, their results are saved before its error is raised
+        for error in await asyncio.gather(*(export_chunk(chunk) for chunk in chunks(list(games_dic), LOOKUP_CHUNK_SIZE)), return_exceptions=True):
+            if isinstance(error, BaseException):
+                raise error
+        log.info(f"Round {round_nb}, {finished} games finished, {len(games_dic) - finished} still running")
+        return len(games_dic) - finished
+
+    async def export_games(self: AsyncPairing, game_ids: Iterable[str]) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the games one by one as lichess streams them, without waiting for the whole export"""
+        async with self.sem:
+            async with await self.retrier.arequest(self.http, "POST", LOOKUP_API, data=",".join(game_ids), params={"moves": "false"}) as r:
+                r.raise_for_status()
+                async for line in r.content:
+                    line = line.strip()
+                    if not line: # keep-alive
+                        continue
+                    log.debug(line)
+                    yield json.loads(line)
 
 #############
 # Functions #
 #############
 
+def is_username(token: str) -> bool:
+    return len(token) in USERNAME_LENGTHS and USERNAME_CHARS.issuperset(token)
+
+def is_rating(token: str) -> bool:
+    return token.isdecimal() and (len(token) in RATING_LENGTHS or token == "0")
+
+def column_kind(token: str) -> str:
+    """Rough type of a column, to tell which ones players have in common"""
+    if token.replace("½", "").replace(".", "").isdecimal() or token == "½":
+        return "number"
+    if len(token) == 3 and token.isalpha() and token.isupper():
+        return "federation"
+    return "text"
+
+def refused(e: BaseException) -> bool:
+    """Whether `e` is lichess answering a challenge with a 4xx, in which case no game was created"""
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+    elif isinstance(e, aiohttp.ClientResponseError):
+        status = e.status
+    else:
+        return False
+    return status is not None and 400 <= status < 500
+
+def response_error(r: aiohttp.ClientResponse, message: str = "") -> aiohttp.ClientResponseError:
+    """Error for a failed response, without the request's headers: they hold the token, and errors are logged"""
+    request_info = r.request_info._replace(headers=CIMultiDictProxy(CIMultiDict()))
+    return aiohttp.ClientResponseError(request_info, r.history, status=r.status, message=message)
+
+def chunks(l: List[str], size: int) -> List[List[str]]:
+    """Split `l` in consecutive lists of at most `size` elements"""
+    return [l[i:i + size] for i in range(0, len(l), size)]
+
 def create_db(*args) -> None:
     """Setup the sqlite database, should be run once first when getting the script"""
     db = Db()
     db.create_db()
 
+def upgrade_db(*args) -> None:
+    """Apply the latest settings and indexes to an existing database, safe to run several times"""
+    db = Db()
+    db.upgrade_db()
+
+def check_db(*args) -> None:
+    """Check that the queries by round use the indexes, exit with an error otherwise"""
+    db = Db()
+    if not db.check_query_plans():
+        sys.exit(1)
+
 def show(*args) -> None:
     """Show the current state of the database. For debug purpose only"""
     db = Db()
@@ -287,28 +1724,102 @@ def test(*args) -> None:
     p = Pairing(db)
     p.test()
 
-def fetch(round_nb: int) -> None:
-    """Takes the raw dump from the `G_DOC_PATH` copied document and store the pairings in the db, without launching the challenges"""
-    f = FileHandler(Db())
-    f.fetch(round_nb)
+def fetch(round_nb: int, args: argparse.Namespace) -> None:
+    """Takes the raw dump from the `G_DOC_PATH` copied document and store the pairings in the db, without launching the challenges.
+    Can be run again after the document is corrected, only the boards added or removed since the last run are changed.
+    With `--watch`, keep importing the boards appended to the document as they are written, and with `--pair` create their games right away"""
+    db = Db()
+    f = FileHandler(db)
+    if not args.watch:
+        f.fetch(round_nb)
+        return
+    on_import = None
+    if args.pair:
+        p = Pairing(db, concurrency=args.concurrency, scheduler=RequestScheduler(args.rate, args.burst), timeout=(args.connect_timeout, args.read_timeout), deadline=args.deadline, transport=args.transport)
+        on_import = lambda: p.pair_all_players(round_nb)
+    try:
+        f.watch(round_nb, on_import)
+    except KeyboardInterrupt:
+        log.info(f"Round {round_nb}, stopped watching")
+    finally:
+        if args.pair:
+            log.info(f"fetch: {p.retrier.report()}")
 
-def pair(round_nb: int) -> None:
-    """Create a challenge for every couple of players that has not been already paired"""
+def pair(round_nb: int, args: argparse.Namespace) -> None:
+    """Create a challenge for every couple of players that has not been already paired, `--concurrency` at a time.
+    With `--bulk`, all games are created with a single request, using the players' tokens from `PLAYER_TOKENS_PATH`.
+    With `--at HH:MM:SS`, all challenges are prepared in advance and sent at once at that time.
+    Challenges sent by a previous run but never confirmed are first looked up on lichess, and only sent again if no game was found"""
     db = Db()
-    p = Pairing(db)
-    p.pair_all_players(round_nb)
+    if args.asyncio:
+        asyncio.run(async_pair(db, round_nb, args))
+        return
+    p = Pairing(db, concurrency=args.concurrency, scheduler=RequestScheduler(args.rate, args.burst), timeout=(args.connect_timeout, args.read_timeout), deadline=args.deadline, transport=args.transport)
+    try:
+        if args.bulk:
+            p.bulk_pair_all_players(round_nb)
+        elif args.at:
+            p.scheduled_pair_all_players(round_nb, args.at)
+        else:
+            p.pair_all_players(round_nb)
+    finally:
+        log.info(f"pair: {p.retrier.report()}")
+
+async def async_pair(db: Db, round_nb: int, args: argparse.Namespace) -> None:
+    async with AsyncPairing(db, concurrency=args.concurrency, scheduler=RequestScheduler(args.rate, args.burst), timeout=(args.connect_timeout, args.read_timeout), deadline=args.deadline) as p:
+        try:
+            await p.pair_all_players(round_nb)
+        finally:
+            log.info(f"pair: {p.retrier.report()}")
 
-def result(round_nb: int) -> None:
+def validate(round_nb: int, args: argparse.Namespace) -> None:
+    """Check that all players of that round_nb have an open lichess account, and report the boards that can't be paired.
+    Results are cached for `PLAYER_CACHE_TTL` seconds, `pair` skips the boards with an invalid player"""
+    db = Db()
+    p = Pairing(db, concurrency=args.concurrency, timeout=(args.connect_timeout, args.read_timeout), transport=args.transport)
+    try:
+        p.validate_players(round_nb)
+    finally:
+        log.info(f"validate: {p.retrier.report()}")
+
+def result(round_nb: int, args: argparse.Namespace) -> None:
     """Fetch all games from that round_nb, check if they are finished, and print the results"""
     db = Db()
-    p = Pairing(db)
-    p.check_all_results(round_nb)
+    if args.asyncio:
+        asyncio.run(async_result(db, round_nb, args))
+        return
+    p = Pairing(db, concurrency=args.concurrency, timeout=(args.connect_timeout, args.read_timeout), transport=args.transport)
+    try:
+        p.check_all_results(round_nb)
+    finally:
+        log.info(f"result: {p.retrier.report()}")
 
-def broadcast(round_nb: int) -> None:
+async def async_result(db: Db, round_nb: int, args: argparse.Namespace) -> None:
+    async with AsyncPairing(db, concurrency=args.concurrency, timeout=(args.connect_timeout, args.read_timeout)) as p:
+        try:
+            await p.check_all_results(round_nb)
+        finally:
+            log.info(f"result: {p.retrier.report()}")
+
+def watch(round_nb: int, args: argparse.Namespace) -> None:
+    """Follow all unfinished games of that round_nb live, and save each result as soon as the game ends"""
+    db = Db()
+    p = Pairing(db, timeout=(args.connect_timeout, args.read_timeout), transport=args.transport)
+    try:
+        p.watch_results(round_nb)
+    finally:
+        log.info(f"watch: {p.retrier.report()}")
+
+def broadcast(round_nb: int, args: argparse.Namespace) -> None:
     """Return game ids of the round `round_nb` separated by a space"""
     db = Db()
     print(db.get_game_ids(round_nb))
 
+def parse_time(s: str) -> datetime:
+    """Parse `HH:MM:SS` as a time of the current day"""
+    t = datetime.strptime(s, "%H:%M:%S").time()
+    return datetime.combine(datetime.now().date(), t)
+
 def doc(dic: Dict[str, function]) -> str:
     """Produce documentation for every command based on doc of each function"""
     doc_string = ""
@@ -320,17 +1831,35 @@ def main() -> None:
     parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
     commands = {
     "create_db": create_db,
+    "upgrade_db": upgrade_db,
+    "check_db": check_db,
     "show": show,
     "test": test,
     "fetch": fetch,
+    "validate": validate,
     "pair": pair,
     "result": result,
+    "watch": watch,
     "broadcast": broadcast,
     }
     parser.add_argument("command", choices=commands.keys(), help=doc(commands))
-    parser.add_argument("round_nb", nargs='?', default=0, type=int, help="The round number related to the action you want to do. Only used for `fetch`, `pair`, `result`")
+    parser.add_argument("round_nb", nargs='?', default=0, type=int, help="The round number related to the action you want to do. Only used for `fetch`, `validate`, `pair`, `result`, `watch`")
+    parser.add_argument("--concurrency", default=PAIRING_CONCURRENCY, type=int, help="Maximum number of challenges created at the same time. Only used for `pair`")
+    parser.add_argument("--rate", default=CHALLENGE_RATE, type=float, help="Maximum number of challenges created per second. Only used for `pair`")
+    parser.add_argument("--burst", default=CHALLENGE_BURST, type=int, help="Number of challenges that can be sent at once before `--rate` applies. Only used for `pair`")
+    parser.add_argument("--connect-timeout", default=CONNECT_TIMEOUT, type=float, help="Seconds to wait for a connection to lichess")
+    parser.add_argument("--read-timeout", default=READ_TIMEOUT, type=float, help="Seconds to wait for lichess to answer")
+    parser.add_argument("--deadline", type=float, help="Seconds allowed to create the whole round, counted from `--at` if given, the boards left are reported as pending. Only used for `pair`")
+    parser.add_argument("--at", type=parse_time, help="HH:MM:SS, start all the games of the round at that time today. Only used for `pair`")
+    parser.add_argument("--bulk", action="store_true", help="Create the whole round with the bulk pairing API. Only used for `pair`")
+    parser.add_argument("--transport", choices=["http1", "http2"], default="http1", help="`http2` multiplexes all requests over a single connection. Not used with `--asyncio`")
+    parser.add_argument("--watch", action="store_true", help="Keep importing the boards appended to the document until interrupted. Only used for `fetch`")
+    parser.add_argument("--pair", action="store_true", help="Create the games of the boards as soon as they are imported. Only used for `fetch --watch`")
+    parser.add_argument("--asyncio", action="store_true", help="Use the asyncio engine instead of threads. Only used for `pair` and `result`, not with `--at` or `--bulk`")
     args = parser.parse_args()
-    commands[args.command](args.round_nb)
+    if args.asyncio and (args.at or args.bulk):
+        parser.error("--at and --bulk are not supported with --asyncio")
+    commands[args.command](args.round_nb, args)
 
 ########
 # Main #